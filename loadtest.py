@@ -0,0 +1,683 @@
+"""Local synthetic stand-in for the Amazon and Tesco search and product pages.
+
+This is used to measure end-to-end crawl throughput and memory of the
+spiders without hitting the real sites. The server generates search pages
+and product pages with the markup the spiders scrape, with a configurable
+number of results, latency, captcha injection rate and page size.
+
+Run the server on its own::
+
+    python -m product_ranking.spiders.loadtest serve --port 8000
+
+Or run a spider against it and report requests/sec, items/sec and RSS::
+
+    python -m product_ranking.spiders.loadtest amazon -s laundry,soap \\
+        --server-url http://127.0.0.1:8000
+
+Without --server-url the server is started in a child process, with the
+given options, so the rates and RSS only cover the crawl::
+
+    python -m product_ranking.spiders.loadtest amazon -s laundry,soap \\
+        --results 2000 --latency 0.05 --captcha-rate 0.01
+
+Or benchmark the Tesco product data extraction on a large results page::
+
+    python -m product_ranking.spiders.loadtest bench-tesco --results 5000 \\
+        --data-mismatch-rate 0.05
+"""
+from __future__ import division, absolute_import, unicode_literals
+from __future__ import print_function
+from future_builtins import *
+
+import argparse
+import BaseHTTPServer
+import gc
+import json
+import multiprocessing
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+import scrapy.log
+from scrapy import signals
+from scrapy.crawler import Crawler
+from scrapy.utils.project import get_project_settings
+from twisted.internet import reactor, task
+
+from product_ranking.spiders import FormatterWithDefaults
+from product_ranking.spiders.amazon import AmazonProductsSpider
+from product_ranking.spiders.tesco import TescoProductsSpider
+
+
+AMAZON_PRODS_PER_PAGE = 16
+TESCO_PRODS_PER_PAGE = 20
+
+# Only the presence of this string is checked to detect a captcha page.
+CAPTCHA_MARKER = '.images-amazon.com/captcha/'
+
+WORDS = (
+    'ultra', 'fresh', 'original', 'classic', 'natural', 'sensitive', 'value',
+    'family', 'pack', 'extra', 'care', 'deluxe', 'lavender', 'citrus', 'mint',
+    'organic', 'large', 'small', 'travel', 'refill', 'concentrated', 'pure',
+)
+
+BRANDS = (
+    'Acme', 'Dri Pak', 'Alberto Balsam', 'Dr. Bronner', 'Head & Shoulders',
+    'Girlz Only', 'Mum & Me', 'Generic', 'Tesco',
+)
+
+
+class SyntheticSiteConfig(object):
+    """Parameters of the synthetic pages.
+
+    `results` is the total number of matches reported for every search term,
+    `latency` the delay in seconds before each response is sent,
+    `captcha_rate` the probability of an Amazon product page being replaced
+    by a captcha challenge and `page_size` the minimum size in bytes of every
+    HTML page, reached by padding it. With a `data_mismatch_rate` above 0
+    that fraction of the Tesco product data entries is dropped and the rest
+    is shuffled, so they no longer line up with the product links.
+    """
+
+    def __init__(self, results=1000, latency=0.0, captcha_rate=0.0,
+                 page_size=0, data_mismatch_rate=0.0, seed=0):
+        self.results = int(results)
+        self.latency = float(latency)
+        self.captcha_rate = float(captcha_rate)
+        self.page_size = int(page_size)
+        self.data_mismatch_rate = float(data_mismatch_rate)
+        self.seed = seed
+
+
+def _rand_for(config, *keys):
+    """Returns a random generator seeded for the given page so that the same
+    page is always generated identically.
+    """
+    return random.Random('%s|%s' % (config.seed, '|'.join(map(str, keys))))
+
+
+def _product_title(rand):
+    return '%s %s' % (
+        rand.choice(BRANDS),
+        ' '.join(rand.choice(WORDS) for _ in range(rand.randint(3, 8))),
+    )
+
+
+def _pad(html, page_size):
+    missing = page_size - len(html)
+    if missing <= 0:
+        return html
+    filler = '<!-- %s -->' % ('x' * max(missing - 9, 0))
+    return html.replace('</body>', filler + '</body>')
+
+
+def _page_count(results, per_page):
+    return (results + per_page - 1) // per_page
+
+
+def amazon_search_page(config, search_term, page):
+    page_count = _page_count(config.results, AMAZON_PRODS_PER_PAGE)
+    first = (page - 1) * AMAZON_PRODS_PER_PAGE
+    last = min(first + AMAZON_PRODS_PER_PAGE, config.results)
+
+    if config.results == 0:
+        header = '<h1 id="noResultsTitle">No results.</h1>'
+    else:
+        header = '<h2 id="resultCount"><span>Showing %d - %d of %s Results' \
+            '</span></h2>' % (first + 1, last, format(config.results, ','))
+
+    prods = []
+    for i in range(first, last):
+        rand = _rand_for(config, 'amazon', search_term, i)
+        prods.append(
+            '<div class="prod" id="result_%d"><h3>'
+            '<a href="/amazon/dp/B%09d">%s</a></h3></div>'
+            % (i, rand.randint(0, 10 ** 9 - 1), _product_title(rand))
+        )
+
+    next_link = ''
+    if page < page_count:
+        next_link = '<a id="pagnNextLink" href="/amazon/s/?%s">Next</a>' \
+            % urllib.urlencode(
+                {'field-keywords': search_term, 'page': page + 1})
+
+    return (
+        '<html><head><title>Amazon.com: %s</title></head><body>'
+        '%s<div id="atfResults">%s</div>%s</body></html>'
+        % (search_term, header, ''.join(prods), next_link)
+    )
+
+
+def amazon_product_page(config, asin):
+    rand = _rand_for(config, 'amazon', asin)
+    title = _product_title(rand)
+    brand = title.split()[0]
+    image = 'http://ecx.images-amazon.com/images/I/%s.jpg' % asin
+    images = {
+        image.replace('.jpg', '._SL%d_.jpg' % size): [size, size]
+        for size in (300, 500, 1000)
+    }
+    return (
+        '<html><head><title>%(title)s</title></head><body>'
+        '<span id="productTitle">%(title)s</span>'
+        '<a id="brand">%(brand)s</a>'
+        '<span id="priceblock_ourprice">$%(price).2f</span>'
+        '<div id="imgTagWrapperId"><img id="landingImage"'
+        ' data-old-hires="%(image)s" data-a-dynamic-image="%(images)s">'
+        '</div>'
+        '<div class="productDescriptionWrapper">%(description)s</div>'
+        '<table><tr><td class="bucket"><div class="content"><ul>'
+        '<li><b>ASIN: </b>%(asin)s</li>'
+        '<li><b>Item model number:</b> M-%(model)d</li>'
+        '<li><b>UPC:</b> %(upc)d %(upc2)d</li>'
+        '</ul></div></td></tr></table>'
+        '</body></html>'
+    ) % {
+        'title': title,
+        'brand': brand,
+        'price': rand.uniform(1, 100),
+        'image': image,
+        'images': json.dumps(images).replace('"', '&quot;'),
+        'description': ' '.join(rand.choice(WORDS) for _ in range(60)),
+        'asin': asin,
+        'model': rand.randint(1000, 99999),
+        'upc': rand.randint(10 ** 11, 10 ** 12 - 1),
+        'upc2': rand.randint(10 ** 11, 10 ** 12 - 1),
+    }
+
+
+def amazon_captcha_page(asin):
+    return (
+        '<html><head><title>Robot Check</title></head><body>'
+        '<form method="get" action="/amazon/dp/%s">'
+        '<img src="/captcha%scaptcha.jpg">'
+        '<input type="text" name="field-keywords">'
+        '</form></body></html>'
+    ) % (asin, CAPTCHA_MARKER)
+
+
+def tesco_image_url(prod_id):
+    return 'http://img.tesco.com/Groceries/pi/%03d/%d/IDShot_225x225.jpg' \
+        % (int(prod_id) % 1000, int(prod_id))
+
+
+def tesco_search_page(config, search_term, page,
+                      per_page=TESCO_PRODS_PER_PAGE):
+    page_count = _page_count(config.results, per_page)
+    first = (page - 1) * per_page
+    last = min(first + per_page, config.results)
+
+    prods = []
+    pushes = []
+    for i in range(first, last):
+        rand = _rand_for(config, 'tesco', search_term, i)
+        prod_id = rand.randint(10 ** 8, 10 ** 9 - 1)
+        name = _product_title(rand)
+        prods.append(
+            '<li class="product"><div class="desc"><h2>'
+            '<a href="/tesco/product/details/?id=%d">%s</a></h2></div></li>'
+            % (prod_id, name)
+        )
+        pushes.append('tesco.productData.push(%s);' % json.dumps({
+            'productId': str(prod_id),
+            'name': name,
+            'price': '%.2f' % rand.uniform(0.5, 20),
+            'mediumImage': tesco_image_url(prod_id),
+        }))
+
+    if config.data_mismatch_rate:
+        rand = _rand_for(config, 'tesco', search_term, 'page', page)
+        pushes = [p for p in pushes
+                  if rand.random() >= config.data_mismatch_rate]
+        rand.shuffle(pushes)
+
+    next_link = ''
+    if page < page_count:
+        next_link = '<p class="next"><a href="/tesco/search?%s">Next</a></p>' \
+            % urllib.urlencode({'searchBox': search_term, 'page': page + 1})
+
+    return (
+        '<html><head><title>Tesco.com: %(term)s</title>'
+        '<script type="text/javascript">var tesco = tesco || {};'
+        ' tesco.productData = [];</script></head><body>'
+        '<span class="pageTotalItemCount">%(total)d</span>%(next)s'
+        '<ul class="products">%(prods)s</ul>%(next)s'
+        '<script type="text/javascript">\n%(pushes)s\n</script>'
+        '</body></html>'
+    ) % {
+        'term': search_term,
+        'total': config.results,
+        'next': next_link,
+        'prods': ''.join(prods),
+        'pushes': '\n'.join(pushes),
+    }
+
+
+def tesco_product_page(config, prod_id):
+    rand = _rand_for(config, 'tesco', prod_id)
+    return (
+        '<html><head><title>%s</title></head><body>'
+        '<div class="productDetails"><h1>%s</h1><p>%s</p></div>'
+        '</body></html>'
+    ) % (prod_id, prod_id, ' '.join(rand.choice(WORDS) for _ in range(60)))
+
+
+class SyntheticSiteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        config = self.server.config
+        parsed = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(parsed.query))
+        path = parsed.path.rstrip('/')
+
+        # Keep the pseudo-randomness of the captcha injection per server.
+        with self.server.lock:
+            captcha_roll = self.server.rand.random()
+
+        page = int(query.get('page', 1))
+        body = None
+        if path == '/amazon/s':
+            body = amazon_search_page(
+                config, query.get('field-keywords', ''), page)
+        elif path.startswith('/amazon/dp/'):
+            asin = path[len('/amazon/dp/'):]
+            if captcha_roll < config.captcha_rate:
+                body = amazon_captcha_page(asin)
+            else:
+                body = amazon_product_page(config, asin)
+        elif path == '/tesco/search':
+            body = tesco_search_page(config, query.get('searchBox', ''), page)
+        elif path == '/tesco/product/details':
+            body = tesco_product_page(config, query.get('id', ''))
+
+        if config.latency:
+            time.sleep(config.latency)
+
+        if body is None:
+            self.send_error(404)
+            return
+
+        body = _pad(body, config.page_size).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Logging every request would dominate the measurements.
+        pass
+
+
+class SyntheticSiteServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, config):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, SyntheticSiteHandler)
+        self.config = config
+        self.lock = threading.Lock()
+        self.rand = random.Random(config.seed)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+
+def start_server_process(config, host='127.0.0.1', port=0):
+    """Starts a SyntheticSiteServer in a child process.
+
+    Serving from another process keeps the page generation out of the CPU
+    time and memory of the crawl being measured. With the default port of 0
+    a free port is picked. Returns the process and the server's base URL.
+
+    The socket is bound here, before forking, so that failing to bind raises
+    socket.error in the caller.
+    """
+    server = SyntheticSiteServer((host, port), config)
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    # Only the child serves from the socket.
+    server.server_close()
+    return process, server.base_url
+
+
+def _zip_scrape_product_links(spider, response):
+    """The Tesco product extraction before it joined the product data to
+    the links by id, kept as the reference for bench-tesco.
+    """
+    from product_ranking.items import SiteProductItem
+    from product_ranking.spiders import cond_set_value
+
+    url = response.url
+    product_jsons = response.xpath(
+        "//script[@type='text/javascript']/text()"
+    ).re(
+        r"\s*tesco\.productData\.push\((\{.+?\})\);"
+    )
+    product_links = response.css(
+        ".product > .desc > h2 > a ::attr('href')").extract()
+
+    for product_json, product_link in zip(product_jsons, product_links):
+        prod = SiteProductItem()
+        cond_set_value(prod, 'url', urlparse.urljoin(url, product_link))
+
+        product_data = json.loads(product_json)
+
+        cond_set_value(prod, 'price', product_data.get('price'))
+        cond_set_value(prod, 'image_url', product_data.get('mediumImage'))
+
+        brand, title = spider.brand_from_title(product_data['name'])
+        cond_set_value(prod, 'brand', brand)
+        cond_set_value(prod, 'title', title)
+
+        yield None, prod
+
+
+def _bench_tesco_extractor(name, scrape, url, body, products, repeat, out):
+    from scrapy.http import HtmlResponse
+
+    timings = []
+    for _ in range(repeat):
+        # A new response each time so the parsed document is not reused.
+        response = HtmlResponse(url, body=body, encoding='utf-8')
+        # As timeit does, so the garbage left by previous runs, of either
+        # extractor, is not collected while timing this one.
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.time()
+            prods = [prod for _, prod in scrape(response)]
+            timings.append(time.time() - start)
+        finally:
+            gc.enable()
+
+    expected = body.count('tesco.productData.push(')
+    wrong = 0
+    for prod in prods:
+        prod_id = urlparse.parse_qs(urlparse.urlparse(prod['url']).query)['id']
+        if prod.get('image_url') != tesco_image_url(prod_id[0]):
+            wrong += 1
+
+    best = min(timings)
+    print("%-9s %d products (%d bytes): %d extracted, %d expected, %d with"
+          " the wrong data, best of %d: %.2f ms (%.1f us/product)" % (
+              name, products, len(body), len(prods), expected, wrong,
+              repeat, best * 1000, best * 10 ** 6 / products),
+          file=out)
+    return best, wrong + abs(len(prods) - expected)
+
+
+def bench_tesco_extraction(products, repeat=10, data_mismatch_rate=0.0,
+                           out=None):
+    """Times TescoProductsSpider._scrape_product_links on a single results
+    page with the given number of products and prints the best run to `out`.
+    The previous extraction, which paired the product data and the links by
+    position, is timed on the same page for reference.
+
+    The extracted products are checked against the page: every product with
+    data must be extracted and its data must be the one of its link, which
+    the image URL identifies. Returns the best time and the number of wrong
+    products of the current extraction.
+    """
+    if out is None:
+        out = sys.stdout
+
+    config = SyntheticSiteConfig(
+        results=products, data_mismatch_rate=data_mismatch_rate)
+    url = 'http://www.tesco.com/groceries/product/search/default.aspx'
+    body = tesco_search_page(config, 'bench', 1, per_page=products)
+    spider = TescoProductsSpider(searchterms_str='bench')
+
+    _bench_tesco_extractor(
+        'reference',
+        lambda response: _zip_scrape_product_links(spider, response),
+        url, body, products, repeat, out,
+    )
+    best, failures = _bench_tesco_extractor(
+        'current', spider._scrape_product_links,
+        url, body, products, repeat, out,
+    )
+    if failures:
+        print("Extraction FAILED.", file=out)
+    return best, failures
+
+
+## Load test harness.
+
+SPIDERS = {
+    'amazon': (
+        AmazonProductsSpider,
+        "http://{host}:{port}/amazon/s/?field-keywords={search_term}",
+    ),
+    'tesco': (
+        TescoProductsSpider,
+        "http://{host}:{port}/tesco/search?searchBox={search_term}",
+    ),
+}
+
+
+def current_rss():
+    """Returns the resident set size of this process in KiB.
+
+    It is read from /proc so None is returned where that is not available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+class CrawlStats(object):
+    """Collects the throughput and memory of a crawl over time."""
+
+    def __init__(self, crawler, out):
+        self.out = out
+        self.requests = 0
+        self.items = 0
+        self.samples = []
+        self.start_time = None
+
+        crawler.signals.connect(self.spider_opened, signals.spider_opened)
+        crawler.signals.connect(
+            self.response_received, signals.response_received)
+        crawler.signals.connect(self.item_scraped, signals.item_scraped)
+
+    def spider_opened(self, spider):
+        self.start_time = time.time()
+
+    def response_received(self, response, request, spider):
+        self.requests += 1
+
+    def item_scraped(self, item, response, spider):
+        self.items += 1
+
+    def sample(self):
+        if self.start_time is None:
+            return
+        elapsed = time.time() - self.start_time
+        sample = (elapsed, self.requests, self.items, current_rss())
+        self.samples.append(sample)
+        print(self.format_sample(*sample), file=self.out)
+
+    @staticmethod
+    def format_sample(elapsed, requests, items, rss):
+        line = "%8.1fs %9d requests %9d items %9.1f req/s %9.1f items/s" % (
+            elapsed,
+            requests,
+            items,
+            requests / elapsed if elapsed else 0,
+            items / elapsed if elapsed else 0,
+        )
+        if rss is not None:
+            line += " %9d KiB RSS" % rss
+        return line
+
+    def report(self):
+        self.sample()
+        if self.samples:
+            print("Total:  " + self.format_sample(*self.samples[-1]),
+                  file=self.out)
+            rss_samples = [s[3] for s in self.samples if s[3] is not None]
+            if rss_samples:
+                print("Peak RSS: %d KiB" % max(rss_samples), file=self.out)
+
+
+def run_spider(site, base_url, searchterms, quantity=None, interval=1.0,
+               settings=None, loglevel='INFO', out=None):
+    """Crawls the synthetic server at `base_url` with the spider for `site`.
+
+    The spider's SEARCH_URL and allowed domains are overriden to point to the
+    server. Progress is sampled every `interval` seconds to `out`. Returns
+    the CrawlStats.
+
+    Scrapy logs every request and item at DEBUG level, which would dominate
+    the measurements, so `loglevel` overrides LOG_LEVEL.
+    """
+    if out is None:
+        out = sys.stdout
+
+    spider_class, search_url = SPIDERS[site]
+    parsed_url = urlparse.urlparse(base_url)
+    host, port = parsed_url.hostname, parsed_url.port or 80
+
+    spider = spider_class(
+        url_formatter=FormatterWithDefaults(host=host, port=port),
+        quantity=quantity,
+        searchterms_str=','.join(searchterms),
+        site_name=spider_class.allowed_domains[0],
+    )
+    spider.SEARCH_URL = search_url
+    spider.allowed_domains = [host]
+
+    if settings is None:
+        settings = get_project_settings()
+    settings.set('LOG_LEVEL', loglevel, priority='cmdline')
+    crawler = Crawler(settings)
+    crawler.signals.connect(reactor.stop, signal=signals.spider_closed)
+    crawler.configure()
+    scrapy.log.start_from_crawler(crawler)
+
+    stats = CrawlStats(crawler, out)
+    sampler = task.LoopingCall(stats.sample)
+    sampler.start(interval, now=False)
+
+    crawler.crawl(spider)
+    crawler.start()
+    reactor.run()
+
+    stats.report()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        'mode', choices=['serve', 'bench-tesco'] + sorted(SPIDERS),
+        help="Only run the server, benchmark the Tesco product data"
+             " extraction on a page of --results products or crawl the"
+             " server with the given spider.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--server-url', default=None,
+                        help="Crawl an already running server instead of"
+                             " starting one, e.g. http://127.0.0.1:8000."
+                             " The page options cannot be used with it.")
+    parser.add_argument('-s', '--searchterms', default='laundry',
+                        help="Comma separated search terms.")
+    parser.add_argument('-q', '--quantity', type=int, default=None)
+    parser.add_argument('--results', type=int, default=1000,
+                        help="Total results for every search term.")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds to wait before each response.")
+    parser.add_argument('--captcha-rate', type=float, default=0.0,
+                        help="Probability of a product page being a captcha.")
+    parser.add_argument('--page-size', type=int, default=0,
+                        help="Minimum page size in bytes.")
+    parser.add_argument('--data-mismatch-rate', type=float, default=0.0,
+                        help="Fraction of Tesco product data dropped, the"
+                             " rest is shuffled.")
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="Seconds between progress reports.")
+    parser.add_argument('--loglevel', default='INFO',
+                        help="Scrapy log level of the crawl. DEBUG logs every"
+                             " request and item, skewing the rates.")
+    parser.add_argument('--repeat', type=int, default=10,
+                        help="Benchmark runs, the best one is reported.")
+    args = parser.parse_args(argv)
+
+    if args.server_url is not None:
+        page_options = [
+            '--%s' % dest.replace('_', '-')
+            for dest in ('results', 'latency', 'captcha_rate', 'page_size',
+                         'data_mismatch_rate')
+            if getattr(args, dest) != parser.get_default(dest)
+        ]
+        if page_options:
+            parser.error(
+                "%s only apply to a server started by this command, not to"
+                " --server-url" % ', '.join(page_options))
+
+    if args.mode == 'bench-tesco':
+        if args.results < 1:
+            parser.error("bench-tesco needs --results of at least 1")
+        if args.repeat < 1:
+            parser.error("bench-tesco needs --repeat of at least 1")
+        _, failures = bench_tesco_extraction(
+            args.results, args.repeat, args.data_mismatch_rate)
+        sys.exit(1 if failures else 0)
+
+    config = SyntheticSiteConfig(
+        results=args.results,
+        latency=args.latency,
+        captcha_rate=args.captcha_rate,
+        page_size=args.page_size,
+        data_mismatch_rate=args.data_mismatch_rate,
+    )
+    if args.mode == 'serve':
+        server = SyntheticSiteServer((args.host, args.port), config)
+        print("Serving synthetic sites on %s" % server.base_url)
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    server_process = None
+    base_url = args.server_url
+    if base_url is None:
+        server_process, base_url = start_server_process(
+            config, args.host, args.port)
+        print("Serving synthetic sites on %s (pid %d)"
+              % (base_url, server_process.pid))
+
+    try:
+        run_spider(
+            args.mode,
+            base_url,
+            args.searchterms.split(','),
+            quantity=args.quantity,
+            interval=args.interval,
+            loglevel=args.loglevel,
+        )
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.join()
+
+
+if __name__ == '__main__':
+    main()
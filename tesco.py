@@ -2,14 +2,24 @@ from __future__ import division, absolute_import, unicode_literals
 from future_builtins import *
 
 import json
+import re
 import urlparse
 
-from scrapy.log import ERROR
+from scrapy.log import ERROR, WARNING
 
 from product_ranking.items import SiteProductItem
 from product_ranking.spiders import BaseProductsSpider, cond_set_value
 
 
+# Results pages are expected to push the data of each listed product, one
+# entry per statement, as in:
+#   tesco.productData.push({"productId": "254656590", "name": "...", ...});
+# and to link to its page with the same id:
+#   <div class="desc"><h2><a href="/groceries/product/details/?id=254656590">
+PRODUCT_DATA_RE = re.compile(r"tesco\.productData\.push\((\{.+?\})\);")
+PRODUCT_ID_RE = re.compile(r"[?&]id=(\d+)")
+
+
 def brand_at_start(brand):
     return (
         lambda t: t.lower().startswith(brand.lower()),
@@ -67,25 +77,58 @@ class TescoProductsSpider(BaseProductsSpider):
         url = response.url
 
         # This will contain everything except for the URL and description.
-        product_jsons = response.xpath(
-            "//script[@type='text/javascript']/text()"
-        ).re(
-            r"\s*tesco\.productData\.push\((\{.+?\})\);"
-        )
-        if not product_jsons:
+        products_data = self._scrape_products_data(response)
+        if not products_data:
             self.log("Found no product data on: %s" % url, ERROR)
+            return
 
         product_links = response.css(
             ".product > .desc > h2 > a ::attr('href')").extract()
         if not product_links:
             self.log("Found no product links on: %s" % url, ERROR)
+            return
+
+        products_by_id = {}
+        for product_data in products_data:
+            product_id = product_data.get('productId')
+            if product_id is not None:
+                products_by_id[unicode(product_id)] = product_data
+
+        link_ids = [
+            self._product_id_from_link(link) for link in product_links]
+        if any(link_id in products_by_id for link_id in link_ids):
+            if len(products_by_id) < len(products_data):
+                self.log(
+                    "Skipped %d product data entries without an id on: %s"
+                    % (len(products_data) - len(products_by_id), url),
+                    ERROR
+                )
+            links_data = (
+                (link, products_by_id.get(link_id))
+                for link, link_id in zip(product_links, link_ids)
+            )
+        else:
+            # The page does not follow the expected format, so the best
+            # that can be done is relying on the order of both.
+            self.log(
+                "No product link id matches a product data id, pairing them"
+                " by position on: %s" % url,
+                WARNING
+            )
+            links_data = zip(product_links, products_data)
+
+        for product_link, product_data in links_data:
+            if product_data is None:
+                self.log(
+                    "Found no product data for %s on: %s"
+                    % (product_link, url),
+                    ERROR
+                )
+                continue
 
-        for product_json, product_link in zip(product_jsons, product_links):
             prod = SiteProductItem()
             cond_set_value(prod, 'url', urlparse.urljoin(url, product_link))
 
-            product_data = json.loads(product_json)
-
             cond_set_value(prod, 'price', product_data.get('price'))
             cond_set_value(prod, 'image_url', product_data.get('mediumImage'))
 
@@ -101,6 +144,43 @@ class TescoProductsSpider(BaseProductsSpider):
 
             yield None, prod
 
+    def _scrape_products_data(self, response):
+        """Returns the JS product data of a results page in page order.
+
+        Only the script that pushes the product data is scanned and all its
+        entries are decoded with a single call to json.loads. If that fails,
+        the entries are decoded one by one and the invalid ones are skipped.
+        """
+        url = response.url
+
+        scripts = response.xpath(
+            "//script[@type='text/javascript']"
+            "[contains(text(), 'tesco.productData.push')]/text()"
+        ).extract()
+        product_jsons = PRODUCT_DATA_RE.findall('\n'.join(scripts))
+        if not product_jsons:
+            return []
+
+        try:
+            products_data = json.loads('[%s]' % ','.join(product_jsons))
+        except ValueError:
+            products_data = []
+            for product_json in product_jsons:
+                try:
+                    products_data.append(json.loads(product_json))
+                except ValueError as e:
+                    self.log(
+                        "Failed to decode product data %r on %s: %s"
+                        % (product_json, url, e),
+                        ERROR
+                    )
+        return products_data
+
+    @staticmethod
+    def _product_id_from_link(link):
+        match = PRODUCT_ID_RE.search(link)
+        return match.group(1) if match else None
+
     def _scrape_next_results_page_link(self, response):
         next_pages = response.css('p.next > a ::attr(href)').extract()
         next_page = None